@@ -1,7 +1,76 @@
 from fastai.basic_train import LearnerCallback
 from fastai.basic_train import Learner
+# Private helper `learn.pred_batch` uses to turn raw outputs into predictions; ties us to fastai v1 versions that have it
+from fastai.basic_train import _loss_func2activ
+from fastai.core import has_arg, is_listy
+from fastai.torch_core import get_model, grab_idx, rank_distrib, to_detach
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import logging
+import torch
 
-class SaveEveryNIterations(LearnerCallback):
+logger = logging.getLogger(__name__)
+
+# fastai only reads the dicts callbacks return, so hot paths can share these instead of building new ones
+_SKIP_BOTH = {'skip_step': True, 'skip_zero': True}
+_SKIP_ZERO = {'skip_zero': True}
+_STOP = {'stop_epoch': True, 'stop_training': True}
+
+def _cpu_copy(o):
+    """Copies every tensor in a (nested) state dict to the CPU, so the copy can be written while training goes on"""
+    if isinstance(o, torch.Tensor):
+        return o.detach().to('cpu', copy=True) # One copy, even for CPU tensors
+    if isinstance(o, dict):
+        res = type(o)((k, _cpu_copy(v)) for k, v in o.items())
+        if hasattr(o, '_metadata'):
+            res._metadata = o._metadata
+        return res
+    if isinstance(o, (list, tuple)):
+        return type(o)(_cpu_copy(v) for v in o)
+    return o
+
+class _IterCallback(LearnerCallback):
+    """Shared `num_iterations`/`disable_callback` plumbing for the callbacks below.
+    Subclasses (re)initialise their counters in `_reset`"""
+
+    def __init__(self, learn: Learner, num_iterations: int, disable_callback: bool = False):
+        super().__init__(learn)
+        self.num_iterations = num_iterations
+        self.disable_callback = disable_callback
+        self._reset()
+
+    def on_train_begin(self, **kwargs):
+        self._reset() # The same instance can be reused across `fit` calls when passed through `callbacks=`
+
+    def _reset(self):
+        pass
+
+
+class _IterIntervalCallback(_IterCallback):
+    """Calls `_fire` with the batch's state once every `num_iterations` training batches"""
+
+    def _reset(self):
+        self._ticks = self.num_iterations # Counts down to the next `_fire`
+        self._iter = 0 # Training batches seen so far in this `fit`
+
+    def on_batch_end(self, train, **kwargs):
+        if self.disable_callback or not train:
+            return
+        self._iter += 1
+        ticks = self._ticks - 1
+        if ticks:
+            self._ticks = ticks
+            return
+        self._ticks = self.num_iterations
+        return self._fire(**kwargs)
+
+    def _fire(self, **kwargs):
+        """Called with the batch's state every `num_iterations` training batches; does nothing by default.
+        Whatever it returns is passed back to fastai as the result of `on_batch_end`"""
+        pass
+
+
+class SaveEveryNIterations(_IterIntervalCallback):
     """Saves model after every N iterations
     We save all models with the same name as otherwise rather heavy models can quickly gobble up
     all available disk space.
@@ -11,102 +80,197 @@ class SaveEveryNIterations(LearnerCallback):
                                               save_name="saved_every_100_iterations")
     learn = create_cnn(data, models.resnet18, callback_fns = [saver_callback])
     """
+
     def __init__(self, learn: Learner, num_iterations: int = 100, save_name=None, disable_callback:bool=False):
         """
         :param num_iterations: Saves model after every `num_iterations` iterations
         :param save_name: [optional] Filename to save model with
         """
-        super().__init__(learn)
-        self.num_iterations = num_iterations
+        super().__init__(learn, num_iterations, disable_callback)
         self.save_name = save_name
         if save_name is None:
             self.save_name = f'saved_every_{self.num_iterations}_iterations'
+        self._save_path = Path(self.learn.path)/self.learn.model_dir/f'{self.save_name}.pth'
+        self._save_path.parent.mkdir(parents=True, exist_ok=True)
+        self._executor = None # Writes checkpoints in the background, created on first save
+        self._pending = None # Future of the checkpoint currently being written
+
+    def _fire(self, **kwargs):
+        if type(self.learn.model) == type(lambda x: x): # Checking if model is a function (changed by SkipNIterations0
+            return
+        self._save()
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Model saved as %s | Iteration : %d", self.save_name, self._iter)
+
+    def on_train_end(self, exception=False, **kwargs) -> None:
+        """Waits for the last checkpoint to hit the disk"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if not exception:
+            self._flush()
+        elif self._pending is not None:
+            # Don't mask the exception that is ending training with one from the background save
+            pending, self._pending = self._pending, None
+            if pending.exception() is not None:
+                logger.error("Saving %s failed", self._save_path, exc_info=pending.exception())
+
+    def _flush(self):
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result() # Re-raises any error from the background save
 
-    def on_batch_end(self, iteration, **kwargs) -> None:
-        if iteration % self.num_iterations == 0 and iteration != 0:
-            #TODO : Report to Fastai : param names are different for saving model in language_model_learner
-            if type(learn.model) == type(lambda x: x): # Checking if model is a function (changed by SkipNIterations0
-                return
-            self.learn.save(self.save_name)
-            print(f"Model saved as {self.save_name} | Iteration : {iteration}")
+    def _save(self):
+        """Snapshots the weights (and optimizer state) to CPU and writes them on a background thread so training
+        can carry on. Writes the same file as `learn.save(self.save_name)`"""
+        if rank_distrib(): # Only the main process saves in distributed training
+            return
+        self._flush() # Only one checkpoint in flight at a time
+        state = get_model(self.learn.model).state_dict()
+        if getattr(self.learn, 'opt', None) is not None:
+            state = {'model': state, 'opt': self.learn.opt.state_dict()}
+        snapshot = _cpu_copy(state)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = self._executor.submit(torch.save, snapshot, self._save_path)
 
 
-class StopAfterNIterations(LearnerCallback):
+class StopAfterNIterations(_IterIntervalCallback):
     """Stops model after N iterations.
     Usage:
     stopper = partial(StopAfterNIterations, num_iterations = 17)
     learn = create_cnn(data, models.resnet18, callback_fns = [stopper])
     """
+
     def __init__(self, learn: Learner, num_iterations:int=100, disable_callback:bool=False):
         """
         :param num_iterations: Stops model after every `num_iterations` iterations
         """
-        super().__init__(learn)
-        self.num_iterations = num_iterations
-        self.stop_training = False
+        super().__init__(learn, num_iterations, disable_callback)
 
-    def on_batch_end(self, iteration, **kwargs) -> None:
-        if iteration == self.num_iterations:
-            print(f"Iteration {iteration} reached. Stopping Training")
-            self.stop_training = True
-            return {'stop_training': self.stop_training}
-
-    def on_epoch_end(self, **kwargs) ->bool:
-        if self.stop_training:
-            print('Run learn.validate(learn.data.valid_dl) to see results')
-            return {'stop_training': self.stop_training}
+    def _fire(self, **kwargs):
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Iteration %d reached. Stopping Training", self._iter)
+            logger.info('Run learn.validate(learn.data.valid_dl) to see results')
+        return _STOP # Ends the epoch right after this batch, then ends training
 
 
-class GradientAccumulator(LearnerCallback):
+class GradientAccumulator(_IterCallback):
     """Accumulates gradients over N iterations
     Usage:
     accumulator = partial(GradientAccumulator, num_iterations=100)
     learn = create_cnn(data, models.resnet18, callback_fns = [accumulator])
     """
+
     def __init__(self, learn: Learner, num_iterations: int = 4, disable_callback: bool = False):
         """
         :param num_iterations: Accumulate gradients over `num_iterations` iterations before taking an optimizer step
         """
-        super().__init__(learn)
-        self.num_iterations = num_iterations
+        super().__init__(learn, num_iterations, disable_callback)
+
+    @property
+    def num_iterations(self) -> int:
+        return self._num_iterations
+
+    @num_iterations.setter
+    def num_iterations(self, value:int):
+        self._num_iterations = value
+        self._loss_scale = 1.0 / value # Accumulated gradients average over the window instead of summing
+
+    def _reset(self):
         self.skipped_last_backprop = False
+        self._count = 0 # Backward passes accumulated in the open window
 
-    def on_backward_end(self, iteration, **kwargs) -> None:
-        if (iteration % self.num_iterations != 0) or (iteration == 0):
+    def on_backward_begin(self, last_loss, **kwargs):
+        if self.disable_callback:
+            if self.skipped_last_backprop: # Disabled mid-window: step on what was accumulated so far
+                self._flush_window()
+            return
+        return {'last_loss': last_loss * self._loss_scale}
+
+    def on_backward_end(self, **kwargs) -> None:
+        if self.disable_callback:
+            return
+        count = self._count + 1
+        if count < self.num_iterations:
+            self._count = count
             self.skipped_last_backprop = True
-            return {'skip_step': True, 'skip_zero': True}
-        else:
-            self.skipped_last_backprop = False
+            return _SKIP_BOTH
+        self._count = 0
+        self.skipped_last_backprop = False
 
     def on_step_end(self, **kwargs):
         if self.skipped_last_backprop:
-            return {'skip_zero': True}
+            return _SKIP_ZERO
 
     def on_epoch_end(self, **kwargs) ->bool:
         """Deals with the edge case of an epoch ending"""
         if self.skipped_last_backprop:
-            self.learn.opt.step()
-            self.learn.opt.zero_grad()
+            self._flush_window()
 
+    def _flush_window(self):
+        """Steps on a partial window of `_count` < N backward passes. Each loss was scaled by 1/N,
+        so the gradients are rescaled by N/`_count` to make the step use their mean"""
+        scale = self.num_iterations / self._count
+        for p in self.learn.model.parameters():
+            if p.grad is not None:
+                p.grad.mul_(scale)
+        self.learn.opt.step()
+        self.learn.opt.zero_grad()
+        self._reset()
 
-class ShowResutsEveryNIterations(LearnerCallback):
+
+class ShowResutsEveryNIterations(_IterIntervalCallback):
     """Shows model results after every N iterations
+    By default the results are those of the training batch that was just used, which saves an extra forward
+    pass and the train/eval switch. Pass `valid=True` to show results on the validation set instead.
 
     Usage:
-    results_callback = partial(SaveEveryNIterations, num_iterations=100)
+    results_callback = partial(ShowResutsEveryNIterations, num_iterations=100)
     learn = create_cnn(data, models.resnet18, callback_fns = [results_callback])
     """
-    def __init__(self, learn: Learner, num_iterations: int = 100, save_name=None, disable_callback:bool=False):
+
+    def __init__(self, learn: Learner, num_iterations: int = 100, save_name=None, disable_callback:bool=False,
+                 valid:bool=False, rows:int=5):
         """
         :param num_iterations: Show model resuts after every `num_iterations` iterations
+        :param valid: Run `learn.show_results()` on the validation set instead of reusing the training batch
+        :param rows: Number of results to show (`rows`*`rows` for images), as in `learn.show_results`
         """
-        super().__init__(learn)
-        self.num_iterations = num_iterations
+        super().__init__(learn, num_iterations, disable_callback)
+        self.valid = valid
+        self.rows = rows
 
-    def on_batch_end(self, iteration, **kwargs) -> None:
-        if iteration % self.num_iterations == 0 and iteration != 0:
-            self.learn.show_results()
+    def _fire(self, last_input, last_output, last_target, **kwargs):
+        if self.valid:
+            self.learn.show_results(rows=self.rows)
             self.learn.model.train()
+            return
+        self._show_batch(last_input, last_output, last_target)
+
+    def _show_batch(self, x, out, y):
+        """Same rendering as `learn.show_results`, on outputs the training loop already computed"""
+        data = self.learn.data
+        ds = data.train_ds
+        x, y = to_detach(x), to_detach(y) # Inputs and targets can be lists of tensors, e.g. tabular or bbox data
+        preds = _loss_func2activ(self.learn.loss_func)(to_detach(out))
+        norm = getattr(data, 'norm', False)
+        if norm:
+            x = data.denorm(x)
+            if norm.keywords.get('do_y', False):
+                y = data.denorm(y, do_x=True)
+                preds = data.denorm(preds, do_x=True)
+        bs = len(x[0]) if is_listy(x) else len(x)
+        n_items = min(self.rows**2 if getattr(ds.x, '_square_show_res', False) else self.rows, bs)
+        preds = [ds.y.analyze_pred(grab_idx(preds, i)) for i in range(n_items)]
+        xs = [ds.x.reconstruct(grab_idx(x, i)) for i in range(n_items)]
+        if has_arg(ds.y.reconstruct, 'x'):
+            ys = [ds.y.reconstruct(grab_idx(y, i), x=x) for i, x in enumerate(xs)]
+            zs = [ds.y.reconstruct(z, x=x) for z, x in zip(preds, xs)]
+        else:
+            ys = [ds.y.reconstruct(grab_idx(y, i)) for i in range(n_items)]
+            zs = [ds.y.reconstruct(z) for z in preds]
+        ds.x.show_xyzs(xs, ys, zs)
 
 
 class SkipNIterations(LearnerCallback):